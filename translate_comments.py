@@ -10,22 +10,250 @@
 5. 保持代码结构和格式不变
 """
 
+import ast
+import asyncio
+import bisect
+import functools
+import hashlib
+import inspect
+import io
+import json
 import os
 import re
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import tokenize
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Tuple
+from typing import Awaitable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 # 导入OpenAI客户端用于翻译
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+
+class RateLimiter:
+    """
+    请求速率限制器
+    
+    分别维护每分钟请求数和每分钟token数两个令牌桶，容量按时间线性恢复。
+    限额为0表示不限制。
+    """
+    
+    def __init__(self, max_requests_per_minute: float = 0, max_tokens_per_minute: float = 0):
+        """
+        初始化速率限制器
+        
+        参数:
+            max_requests_per_minute: 每分钟最大请求数
+            max_tokens_per_minute: 每分钟最大token数
+        """
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_requests = max_requests_per_minute
+        self.available_tokens = max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, tokens: int) -> None:
+        """
+        等待直到有足够的请求和token容量，然后扣减
+        
+        参数:
+            tokens: 本次请求预计消耗的token数
+        """
+        if not self.max_requests_per_minute and not self.max_tokens_per_minute:
+            return
+        
+        async with self._lock:
+            # 单个请求超过每分钟上限时按上限计，避免永远等待
+            if self.max_tokens_per_minute:
+                tokens = min(tokens, self.max_tokens_per_minute)
+            
+            while True:
+                now = time.monotonic()
+                elapsed = now - self.last_update
+                self.last_update = now
+                
+                # 按经过的时间恢复容量
+                self.available_requests = min(
+                    self.available_requests + self.max_requests_per_minute * elapsed / 60.0,
+                    self.max_requests_per_minute,
+                )
+                self.available_tokens = min(
+                    self.available_tokens + self.max_tokens_per_minute * elapsed / 60.0,
+                    self.max_tokens_per_minute,
+                )
+                
+                request_ok = not self.max_requests_per_minute or self.available_requests >= 1
+                token_ok = not self.max_tokens_per_minute or self.available_tokens >= tokens
+                if request_ok and token_ok:
+                    if self.max_requests_per_minute:
+                        self.available_requests -= 1
+                    if self.max_tokens_per_minute:
+                        self.available_tokens -= tokens
+                    return
+                
+                # 计算恢复到所需容量的等待时间
+                wait = 0.0
+                if not request_ok:
+                    wait = max(wait, (1 - self.available_requests) * 60.0 / self.max_requests_per_minute)
+                if not token_ok:
+                    wait = max(wait, (tokens - self.available_tokens) * 60.0 / self.max_tokens_per_minute)
+                await asyncio.sleep(wait)
+
+
+class SourceSpan(NamedTuple):
+    """源码中一处可翻译的注释或文档字符串"""
+    
+    start: int  # 在文件内容中的起始偏移
+    end: int  # 在文件内容中的结束偏移
+    source: str  # 原始token文本
+    text: str  # 待翻译的文本
+    context: str  # 上下文类型：comment或docstring
+    indent: int  # token所在列，用于多行文档字符串的缩进
+
+
+class TranslationCache:
+    """
+    基于SQLite的持久化翻译缓存
+    
+    以 (模型, 上下文类型, 归一化文本) 的哈希为键，跨文件、跨运行复用翻译结果。
+    写入每累计COMMIT_EVERY条自动提交一次，进程被强制终止时最多丢失这部分结果。
+    """
+    
+    COMMIT_EVERY = 100
+    
+    def __init__(self, path: str):
+        """
+        初始化缓存
+        
+        参数:
+            path: SQLite数据库文件路径
+        """
+        self.path = path
+        self._uncommitted = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS templates (fingerprint TEXT PRIMARY KEY, translations TEXT NOT NULL)"
+        )
+    
+    @staticmethod
+    def make_key(model: str, context: str, text: str) -> str:
+        """
+        生成缓存键
+        
+        注释会去掉开头的#并合并空白，文档字符串逐行去除首尾空白，
+        使仅有空白差异的重复文本命中同一条缓存。
+        
+        参数:
+            model: 模型名称
+            context: 文本的上下文类型
+            text: 原文
+            
+        返回:
+            sha256十六进制摘要
+        """
+        if context == "docstring":
+            normalized = '\n'.join(line.strip() for line in text.strip().splitlines())
+        else:
+            normalized = ' '.join(text.strip().lstrip('#').split())
+        return hashlib.sha256(f"{model}|{context}|{normalized}".encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，未命中返回None"""
+        row = self._conn.execute(
+            "SELECT translation FROM translations WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key: str, translation: str) -> None:
+        """写入缓存"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO translations (key, translation) VALUES (?, ?)",
+            (key, translation),
+        )
+        self._mark_dirty()
+    
+    def get_template(self, fingerprint: str) -> Optional[List[str]]:
+        """查询文件结构指纹对应的译文列表，未命中返回None"""
+        row = self._conn.execute(
+            "SELECT translations FROM templates WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def set_template(self, fingerprint: str, translations: List[str]) -> None:
+        """写入文件结构指纹对应的译文列表"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO templates (fingerprint, translations) VALUES (?, ?)",
+            (fingerprint, json.dumps(translations, ensure_ascii=False)),
+        )
+        self._mark_dirty()
+    
+    def _mark_dirty(self) -> None:
+        """记录一次未提交的写入，累计到COMMIT_EVERY条时提交"""
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self.commit()
+    
+    def commit(self) -> None:
+        """提交未保存的写入"""
+        if self._uncommitted:
+            self._conn.commit()
+            self._uncommitted = 0
+    
+    def close(self) -> None:
+        """提交并关闭数据库连接"""
+        self._conn.commit()
+        self._conn.close()
 
 
 class CommentTranslator:
     """Python注释翻译器类"""
     
+    # 单次批量请求最多包含的条目数
+    BATCH_SIZE = 40
+    # 单次批量请求的输入字符上限（约3K token）
+    BATCH_MAX_CHARS = 9000
+    # 内存中保留的已完成文件结构指纹数量上限
+    TEMPLATE_MEMO_SIZE = 1024
+    # OpenAI Batch API单个批处理任务的请求数和输入文件大小上限
+    BATCH_API_MAX_REQUESTS = 50000
+    BATCH_API_MAX_BYTES = 200 * 1024 * 1024
+    # 单条翻译和批量翻译的最大输出token数上限
+    MAX_OUTPUT_TOKENS = 2048
+    MAX_OUTPUT_TOKENS_BATCH = 8192
+    
+    # 中文字符
+    _CJK_RE = re.compile(r'[\u4e00-\u9fff]')
+    # 任意字母（不含数字和下划线），代替逐字符调用str.isalpha
+    _LETTER_RE = re.compile(r'[^\W\d_]')
+    # 不应翻译的工具指令注释，如 "# type: ignore"、"# noqa"、"# pragma: no cover"
+    _PRAGMA_RE = re.compile(r'(?:type:|noqa\b|pragma:|fmt:|isort:|pylint:|mypy:|ruff:)')
+    # 文件头部的编码声明（PEP 263）和Emacs/Vim模式行
+    _CODING_RE = re.compile(r'.*?coding[:=]|-\*-.*-\*-|vim?:')
+    # 连续3个及以上的英文字母，没有它就不可能有需要翻译的文本
+    _ENGLISH_WORD_RE = re.compile(r'[A-Za-z]{3,}')
+    # 字符串前缀和引号
+    _STRING_PREFIX_RE = re.compile(r'([rRuUbBfF]*)("""|\'\'\'|"|\')')
+    
     def __init__(self, base_url: str = "http://localhost:8000/v1", 
                  model: str = "autoglm-phone-9b",
-                 api_key: str = "EMPTY"):
+                 api_key: str = "EMPTY",
+                 max_requests_per_minute: float = 0,
+                 max_tokens_per_minute: float = 0,
+                 cache_path: Optional[str] = None,
+                 max_concurrent_requests: int = 16,
+                 nmt_model_path: Optional[str] = None,
+                 nmt_max_chars: int = 80,
+                 nmt_target_prefix: str = ">>cmn_Hans<<",
+                 max_tokens: Optional[int] = None):
         """
         初始化翻译器
         
@@ -33,55 +261,184 @@ class CommentTranslator:
             base_url: AI模型API的基础URL
             model: 使用的模型名称
             api_key: API密钥
+            max_requests_per_minute: 每分钟最大请求数，0表示不限制
+            max_tokens_per_minute: 每分钟最大token数，0表示不限制
+            cache_path: 持久化缓存文件路径，为None时不使用缓存
+            max_concurrent_requests: 同时进行的最大请求数
+            nmt_model_path: 本地CTranslate2格式英译中模型目录（如opus-mt-en-zh），
+                为None时所有文本都使用大模型翻译
+            nmt_max_chars: 短于该长度的注释交给本地模型翻译
+            nmt_target_prefix: 加在每条原文前的目标语言标记；多目标语言模型
+                （如opus-mt-en-zh）需要它才能稳定输出简体中文，为空时不添加
+            max_tokens: 固定的最大输出token数，为None时按输入长度估算
         """
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
         self.model = model
+        self.rate_limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+        self.max_tokens = max_tokens
+        self.files_written = 0
+        # 文件结构指纹到翻译任务的映射（按最近使用排序），结构相同的文件复用同一份译文
+        self._templates = OrderedDict()
+        self._request_sem = asyncio.Semaphore(max(1, max_concurrent_requests))
+        
+        # 本地翻译模型在首次使用时才加载
+        self.nmt_model_path = nmt_model_path
+        self.nmt_max_chars = nmt_max_chars
+        self.nmt_target_prefix = nmt_target_prefix
+        self._nmt = None
+        self._nmt_tokenizer = None
+        self._nmt_lock = threading.Lock()
+        self._cache = TranslationCache(cache_path) if cache_path else None
+        
+        # 固定的系统提示词：每次请求逐字节相同，便于服务端复用前缀KV缓存
+        self._sys_comment = (
+            "你是一名专业的技术翻译。请将用户提供的Python注释从英文翻译为中文。"
+            "只返回翻译后的中文文本，不要添加#符号或其他前缀，不要添加任何解释。"
+        )
+        self._sys_docstring = (
+            "你是一名专业的技术翻译。请将用户提供的Python文档字符串从英文翻译为中文，保持格式和结构。"
+            "只返回翻译后的中文文本，不要添加任何解释。"
+        )
+        self._sys_batch = (
+            "你是一名专业的技术翻译。请将用户提供的Python注释和文档字符串从英文翻译为中文。\n"
+            "输入为JSONL格式，每行包含id、context（comment表示注释，docstring表示文档字符串）和text字段。\n"
+            '对每一行输入，输出一行JSON：{"id": <相同的id>, "translation": "<中文翻译>"}。\n'
+            "文档字符串需保持格式和结构；注释不要添加#符号或其他前缀。\n"
+            "只输出JSONL，不要添加任何解释。"
+        )
+    
+    def close(self) -> None:
+        """释放翻译器持有的资源"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+    
+    def _cache_get(self, text: str, context: str) -> Optional[str]:
+        """从缓存读取翻译结果"""
+        if self._cache is None:
+            return None
+        return self._cache.get(TranslationCache.make_key(self.model, context, text))
+    
+    def _cache_commit(self) -> None:
+        """提交缓存中尚未保存的写入"""
+        if self._cache is not None:
+            self._cache.commit()
+    
+    def _cache_set(self, text: str, context: str, translated: str) -> None:
+        """将成功的翻译结果写入缓存"""
+        if self._cache is None or not translated or translated == text:
+            return
+        self._cache.set(TranslationCache.make_key(self.model, context, text), translated)
+        
+    def _completion_params(self, system_prompt: str, content: str, max_tokens: int) -> dict:
+        """
+        构建对话补全请求参数，在线请求和Batch API共用
+        
+        参数:
+            system_prompt: 固定的系统提示词
+            content: 用户消息内容（仅包含待翻译文本）
+            max_tokens: 最大输出token数
+            
+        返回:
+            请求参数字典
+        """
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content},
+            ],
+            "max_tokens": max_tokens,
+            # 翻译任务使用贪心解码并固定种子，相同输入得到相同输出
+            "temperature": 0.0,
+            "seed": 0,
+        }
+    
+    async def _create_completion(self, system_prompt: str, content: str, max_tokens: int) -> str:
+        """
+        在速率限制下发送一次流式对话补全请求
         
-    def translate_text(self, text: str, context: str = "comment") -> str:
+        以流式方式接收输出，等待当前响应的同时其他协程可以继续提交请求。
+        
+        参数:
+            system_prompt: 固定的系统提示词
+            content: 用户消息内容（仅包含待翻译文本）
+            max_tokens: 最大输出token数
+            
+        返回:
+            模型输出的完整文本
+        """
+        async with self._request_sem:
+            # 粗略估算token：输入按每3个字符1个token计，再加上输出上限
+            await self.rate_limiter.acquire((len(system_prompt) + len(content)) // 3 + max_tokens)
+            stream = await self.client.chat.completions.create(
+                **self._completion_params(system_prompt, content, max_tokens),
+                stream=True,
+            )
+            
+            parts = []
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+            return ''.join(parts)
+    
+    def _max_tokens_for(self, texts: List[str]) -> int:
+        """
+        根据输入长度估算最大输出token数
+        
+        中文译文按每3个字符1个token估算输入，输出预留2倍余量；
+        批量请求额外为每条JSON输出预留格式开销。
+        
+        参数:
+            texts: 本次请求包含的原文列表
+            
+        返回:
+            最大输出token数
+        """
+        if self.max_tokens:
+            return self.max_tokens
+        
+        estimated = sum(len(text) // 3 for text in texts)
+        if len(texts) == 1:
+            return min(2 * estimated + 64, self.MAX_OUTPUT_TOKENS)
+        return min(2 * estimated + 32 * len(texts) + 64, self.MAX_OUTPUT_TOKENS_BATCH)
+    
+    async def translate_text(self, text: str, context: str = "comment",
+                             allow_nmt: bool = True) -> str:
         """
         使用AI模型翻译文本
         
         参数:
             text: 要翻译的英文文本
             context: 文本的上下文类型（comment/docstring/code）
+            allow_nmt: 是否允许交给本地翻译模型；已由本地模型处理过的文本传False
             
         返回:
             翻译后的中文文本
         """
-        # 如果文本已经包含中文，直接返回
-        if self._contains_chinese(text):
-            return text
-            
-        # 如果文本太短或只是符号，不翻译
-        if len(text.strip()) < 3 or not any(c.isalpha() for c in text):
+        if not self._should_translate(text):
             return text
         
-        # 构建翻译提示
-        if context == "docstring":
-            prompt = f"""请将以下Python文档字符串从英文翻译为中文，保持格式和结构：
-
-{text}
-
-只返回翻译后的中文文本，不要添加任何解释。"""
-        else:
-            prompt = f"""请将以下Python注释从英文翻译为中文：
-
-{text}
-
-只返回翻译后的中文文本，不要添加#符号或其他前缀。"""
+        cached = self._cache_get(text, context)
+        if cached is not None:
+            return cached
+        
+        if allow_nmt and self._use_nmt(text, context):
+            translated = (await self._translate_short([text]))[0]
+            if translated:
+                self._cache_set(text, context, translated)
+                return translated
+        
+        system_prompt = self._sys_docstring if context == "docstring" else self._sys_comment
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=500,
-                temperature=0.3,
-            )
+            max_tokens = self._max_tokens_for([text])
+            translated = (await self._create_completion(system_prompt, text, max_tokens)).strip()
             
-            if response.choices and len(response.choices) > 0:
-                translated = response.choices[0].message.content.strip()
+            if translated:
                 # 清理可能的引号
                 translated = translated.strip('"\'')
+                self._cache_set(text, context, translated)
                 return translated
             else:
                 return text
@@ -90,208 +447,931 @@ class CommentTranslator:
             print(f"翻译错误: {e}")
             return text
     
-    def _contains_chinese(self, text: str) -> bool:
+    async def translate_texts(self, items: List[Tuple[str, str]]) -> List[str]:
+        """
+        在一次请求中批量翻译多条文本
+        
+        参数:
+            items: (文本, 上下文类型) 元组列表，上下文类型为comment或docstring
+            
+        返回:
+            与输入顺序一致的翻译结果列表，无需翻译或翻译失败的条目保持原文
+        """
+        results = [text for text, _ in items]
+        translatable = self._translatable_mask(results)
+        pending = []
+        for i, (text, context) in enumerate(items):
+            if not translatable[i]:
+                continue
+            cached = self._cache_get(text, context)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        
+        # 短注释交给本地翻译模型，一次翻译整批
+        short = [i for i in pending if self._use_nmt(*items[i])]
+        if short:
+            short_translations = await self._translate_short([items[i][0] for i in short])
+            translated_short = set()
+            for i, translated in zip(short, short_translations):
+                if translated:
+                    results[i] = translated
+                    self._cache_set(*items[i], translated)
+                    translated_short.add(i)
+            pending = [i for i in pending if i not in translated_short]
+        
+        # 按条目数和字符数上限分块，每块发送一次请求
+        chunks = []
+        chunk = []
+        chunk_chars = 0
+        for i in pending:
+            text_len = len(items[i][0])
+            if chunk and (len(chunk) >= self.BATCH_SIZE or chunk_chars + text_len > self.BATCH_MAX_CHARS):
+                chunks.append(chunk)
+                chunk = []
+                chunk_chars = 0
+            chunk.append(i)
+            chunk_chars += text_len
+        if chunk:
+            chunks.append(chunk)
+        
+        # 各批次并发请求
+        await asyncio.gather(*(self._translate_chunk(items, c, results) for c in chunks))
+        
+        return results
+    
+    async def translate_texts_batch_api(self, items: List[Tuple[str, str]],
+                                        poll_interval: float = 60.0) -> List[str]:
+        """
+        通过OpenAI Batch API离线翻译多条文本
+        
+        每条文本生成一个/v1/chat/completions请求写入JSONL，上传后创建批处理任务，
+        轮询直到任务结束再下载结果。适合无需交互反馈的大规模翻译。
+        
+        参数:
+            items: (文本, 上下文类型) 元组列表
+            poll_interval: 轮询任务状态的间隔秒数
+            
+        返回:
+            与输入顺序一致的翻译结果列表，无需翻译或翻译失败的条目保持原文
+        """
+        results = [text for text, _ in items]
+        translatable = self._translatable_mask(results)
+        pending = []
+        for i, (text, context) in enumerate(items):
+            if not translatable[i]:
+                continue
+            cached = self._cache_get(text, context)
+            if cached is not None:
+                results[i] = cached
+            else:
+                pending.append(i)
+        
+        if not pending:
+            return results
+        
+        # 构建批处理输入文件，custom_id为条目下标
+        lines = []
+        for i in pending:
+            text, context = items[i]
+            system_prompt = self._sys_docstring if context == "docstring" else self._sys_comment
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._completion_params(system_prompt, text, self._max_tokens_for([text])),
+            }, ensure_ascii=False))
+        
+        # 按单批上限拆分为多个批处理任务，一起提交、一起轮询
+        groups = self._split_batch_lines(lines)
+        submitted = await asyncio.gather(*(self._submit_batch(group) for group in groups))
+        batches = [batch for batch in submitted if batch is not None]
+        
+        finished = []
+        while batches:
+            active = []
+            for batch in batches:
+                if batch.status in ("completed", "failed", "expired", "cancelled"):
+                    finished.append(batch)
+                else:
+                    active.append(batch)
+            if not active:
+                break
+            
+            await asyncio.sleep(poll_interval)
+            batches = []
+            for batch in active:
+                try:
+                    batch = await self.client.batches.retrieve(batch.id)
+                except Exception as e:
+                    # 无法查询的任务放弃，其条目保持原文
+                    print(f"批处理翻译错误 {batch.id}: {e}")
+                    continue
+                counts = batch.request_counts
+                if counts is not None:
+                    print(f"批处理任务 {batch.id}: {batch.status} "
+                          f"({counts.completed}/{counts.total} 完成, {counts.failed} 失败)")
+                else:
+                    print(f"批处理任务 {batch.id}: {batch.status}")
+                batches.append(batch)
+        
+        # 按custom_id合并各任务的输出
+        for batch in finished:
+            if not batch.output_file_id:
+                print(f"批处理任务 {batch.id} 未产生结果: {batch.status}")
+                continue
+            try:
+                output_text = (await self.client.files.content(batch.output_file_id)).text
+            except Exception as e:
+                print(f"批处理翻译错误 {batch.id}: {e}")
+                continue
+            self._merge_batch_output(output_text, items, results)
+            # 批处理结果来之不易，合并后立即落盘
+            self._cache_commit()
+        
+        return results
+    
+    def _split_batch_lines(self, lines: List[str]) -> List[List[str]]:
+        """
+        把批处理请求行拆分为多组，每组不超过Batch API的请求数和文件大小上限
+        
+        参数:
+            lines: JSONL请求行
+            
+        返回:
+            请求行分组列表
+        """
+        groups = []
+        group = []
+        group_bytes = 0
+        for line in lines:
+            # 每行之后还有一个换行符
+            line_bytes = len(line.encode('utf-8')) + 1
+            if group and (len(group) >= self.BATCH_API_MAX_REQUESTS
+                          or group_bytes + line_bytes > self.BATCH_API_MAX_BYTES):
+                groups.append(group)
+                group = []
+                group_bytes = 0
+            group.append(line)
+            group_bytes += line_bytes
+        if group:
+            groups.append(group)
+        return groups
+    
+    async def _submit_batch(self, lines: List[str]):
+        """
+        上传一组请求并创建批处理任务
+        
+        参数:
+            lines: JSONL请求行
+            
+        返回:
+            批处理任务对象；提交失败（如服务端不支持Batch API）时返回None，其条目保持原文
+        """
+        try:
+            input_file = await self.client.files.create(
+                file=("batch.jsonl", '\n'.join(lines).encode('utf-8')),
+                purpose="batch",
+            )
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+        except Exception as e:
+            print(f"批处理翻译错误: {e}")
+            return None
+        print(f"已提交批处理任务 {batch.id}，共 {len(lines)} 条请求")
+        return batch
+    
+    def _merge_batch_output(self, output_text: str, items: List[Tuple[str, str]],
+                            results: List[str]) -> None:
+        """
+        解析批处理输出文件，按custom_id把译文写回results
+        
+        参数:
+            output_text: 输出文件的JSONL内容
+            items: 全部 (文本, 上下文类型) 元组
+            results: 翻译结果列表（原地修改）
+        """
+        for line in output_text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+                i = int(obj["custom_id"])
+                response = obj.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                translated = response["body"]["choices"][0]["message"]["content"].strip()
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+            # 清理可能的引号
+            translated = translated.strip('"\'')
+            if translated:
+                results[i] = translated
+                self._cache_set(*items[i], translated)
+    
+    async def _translate_chunk(self, items: List[Tuple[str, str]], indices: List[int],
+                               results: List[str]) -> None:
+        """
+        翻译一个批次的文本，并将结果写回results
+        
+        参数:
+            items: 全部 (文本, 上下文类型) 元组
+            indices: 本批次包含的条目下标
+            results: 翻译结果列表（原地修改）
+        """
+        # 单条文本无需走JSONL协议
+        if len(indices) == 1:
+            text, context = items[indices[0]]
+            results[indices[0]] = await self.translate_text(text, context, allow_nmt=False)
+            return
+        
+        payload = '\n'.join(
+            json.dumps({"id": i, "context": items[i][1], "text": items[i][0]}, ensure_ascii=False)
+            for i in indices
+        )
+        
+        try:
+            content = await self._create_completion(
+                self._sys_batch, payload, self._max_tokens_for([items[i][0] for i in indices])
+            )
+        except Exception as e:
+            # 请求本身失败时服务端很可能不可用，整批保持原文，不再逐条重试
+            print(f"批量翻译错误: {e}")
+            return
+        translations = self._parse_batch_response(content)
+        
+        # 请求成功但模型漏掉的条目退回到单条翻译
+        missing = [i for i in indices if not translations.get(i)]
+        fallback = await asyncio.gather(
+            *(self.translate_text(*items[i], allow_nmt=False) for i in missing)
+        )
+        translations.update(zip(missing, fallback))
+        
+        for i in indices:
+            results[i] = translations[i]
+            self._cache_set(*items[i], translations[i])
+        self._cache_commit()
+    
+    def _use_nmt(self, text: str, context: str) -> bool:
+        """判断文本是否应交给本地翻译模型"""
+        return (self.nmt_model_path is not None and context == "comment"
+                and len(text) < self.nmt_max_chars)
+    
+    async def _translate_short(self, texts: List[str]) -> List[str]:
+        """
+        使用本地翻译模型批量翻译短注释
+        
+        参数:
+            texts: 英文短注释列表
+            
+        返回:
+            译文列表；本地模型不可用或出错时返回空字符串列表，由调用方改用大模型
+        """
+        try:
+            return await asyncio.to_thread(self._nmt_translate_batch, texts)
+        except Exception as e:
+            print(f"本地模型翻译错误: {e}")
+            return [''] * len(texts)
+    
+    def _nmt_translate_batch(self, texts: List[str]) -> List[str]:
+        """在工作线程中加载（首次）并运行本地翻译模型"""
+        with self._nmt_lock:
+            if self._nmt is None:
+                if self.nmt_model_path is None:
+                    return [''] * len(texts)
+                try:
+                    import ctranslate2
+                    from transformers import AutoTokenizer
+                except ImportError:
+                    print("未安装ctranslate2或transformers，短注释将使用大模型翻译")
+                    self.nmt_model_path = None
+                    return [''] * len(texts)
+                try:
+                    self._nmt_tokenizer = AutoTokenizer.from_pretrained(self.nmt_model_path)
+                    self._nmt = ctranslate2.Translator(self.nmt_model_path, compute_type="int8")
+                except Exception as e:
+                    # 加载失败后不再重试，之后的短注释都使用大模型翻译
+                    print(f"本地模型加载失败，短注释将使用大模型翻译: {e}")
+                    self.nmt_model_path = None
+                    self._nmt_tokenizer = None
+                    return [''] * len(texts)
+        
+        tokenizer = self._nmt_tokenizer
+        prefix = f"{self.nmt_target_prefix} " if self.nmt_target_prefix else ''
+        sources = [
+            tokenizer.convert_ids_to_tokens(tokenizer.encode(prefix + text)) for text in texts
+        ]
+        results = self._nmt.translate_batch(sources)
+        
+        translations = []
+        for result in results:
+            translated = tokenizer.decode(
+                tokenizer.convert_tokens_to_ids(result.hypotheses[0]), skip_special_tokens=True
+            ).strip()
+            # 不含中文的输出视为翻译失败，交给大模型处理
+            translations.append(translated if self._contains_chinese(translated) else '')
+        return translations
+    
+    def _parse_batch_response(self, content: str) -> dict:
+        """
+        解析批量翻译返回的JSONL
+        
+        参数:
+            content: 模型返回的文本
+            
+        返回:
+            id到翻译结果的映射
+        """
+        translations = {}
+        for line in (content or '').splitlines():
+            line = line.strip()
+            if not line.startswith('{'):
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(obj, dict) and isinstance(obj.get("translation"), str):
+                try:
+                    translations[int(obj.get("id"))] = obj["translation"].strip()
+                except (TypeError, ValueError):
+                    continue
+        return translations
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _should_translate(text: str) -> bool:
+        """检查文本是否需要翻译（不含中文且不是过短或纯符号）"""
+        # 如果文本已经包含中文，不翻译
+        if CommentTranslator._contains_chinese(text):
+            return False
+        # 如果文本太短或只是符号，不翻译
+        if len(text.strip()) < 3 or not CommentTranslator._LETTER_RE.search(text):
+            return False
+        return True
+    
+    def _translatable_mask(self, texts: List[str]) -> List[bool]:
+        """
+        批量判断多条文本是否需要翻译
+        
+        把所有文本用\\x00拼接后只运行一次中文正则，再按偏移映射回各条文本。
+        
+        参数:
+            texts: 文本列表
+            
+        返回:
+            与texts一一对应的布尔列表
+        """
+        if not texts:
+            return []
+        
+        # 每条文本在拼接缓冲区中的起始偏移
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + 1
+        
+        has_chinese = [False] * len(texts)
+        for m in self._CJK_RE.finditer('\x00'.join(texts)):
+            has_chinese[bisect.bisect_right(starts, m.start()) - 1] = True
+        
+        return [
+            not chinese and len(text.strip()) >= 3 and self._LETTER_RE.search(text) is not None
+            for text, chinese in zip(texts, has_chinese)
+        ]
+    
+    @staticmethod
+    def _contains_chinese(text: str) -> bool:
         """检查文本是否包含中文字符"""
-        return bool(re.search(r'[\u4e00-\u9fff]', text))
+        return CommentTranslator._CJK_RE.search(text) is not None
     
-    def translate_file(self, file_path: str, dry_run: bool = False) -> bool:
+    async def translate_file(self, file_path: str, dry_run: bool = False,
+                             prefetched: Optional[Awaitable[str]] = None) -> bool:
         """
         翻译单个Python文件中的注释
         
         参数:
             file_path: Python文件路径
             dry_run: 如果为True，只显示将要进行的更改，不实际修改文件
+            prefetched: 已提前发起的读取任务，为None时在此读取文件
             
         返回:
             成功返回True，失败返回False
         """
         try:
-            # 读取文件内容
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            original_content = content
-            lines = content.split('\n')
-            translated_lines = []
-            
-            in_docstring = False
-            docstring_delimiter = None
-            docstring_lines = []
-            docstring_start_idx = 0
-            
-            for i, line in enumerate(lines):
-                # 检查是否是文档字符串的开始或结束
-                stripped = line.strip()
+            if prefetched is None:
+                prefetched = self.read_source(file_path)
+            content = await prefetched
+            
+            # 一次扫描提取所有注释和文档字符串
+            spans = self.extract_spans(content)
+            
+            # 没有需要翻译的文本时直接跳过，不做任何拼接
+            unique = self.collect_candidates(spans)
+            if not unique:
+                return await self.write_result(file_path, content, content, dry_run)
+            
+            # 批量翻译去重后的文本，结构相同的文件直接复用译文
+            table = dict(zip(unique, await self._translate_template(unique)))
+            
+            # 按偏移把翻译结果拼接回源码
+            translated_content = self.apply_translations(content, spans, table)
+            
+            return await self.write_result(file_path, content, translated_content, dry_run)
                 
-                # 处理文档字符串
-                if not in_docstring:
-                    # 检查是否是文档字符串的开始
-                    if stripped.startswith('"""') or stripped.startswith("'''"):
-                        delimiter = '"""' if '"""' in line else "'''"
-                        
-                        # 单行文档字符串
-                        if stripped.count(delimiter) >= 2 and len(stripped) > 6:
-                            # 提取文档字符串内容
-                            doc_content = stripped.strip(delimiter)
-                            if doc_content and not self._contains_chinese(doc_content):
-                                translated = self.translate_text(doc_content, "docstring")
-                                indent = len(line) - len(line.lstrip())
-                                translated_lines.append(' ' * indent + delimiter + translated + delimiter)
-                            else:
-                                translated_lines.append(line)
-                        else:
-                            # 多行文档字符串开始
-                            in_docstring = True
-                            docstring_delimiter = delimiter
-                            docstring_lines = [line]
-                            docstring_start_idx = i
-                    # 处理单行注释
-                    elif '#' in line:
-                        # 分离代码和注释
-                        code_part, comment_part = self._split_code_comment(line)
-                        
-                        if comment_part and not self._contains_chinese(comment_part):
-                            translated_comment = self.translate_text(comment_part, "comment")
-                            translated_lines.append(code_part + '  # ' + translated_comment)
-                        else:
-                            translated_lines.append(line)
-                    else:
-                        translated_lines.append(line)
-                else:
-                    # 在文档字符串内部
-                    docstring_lines.append(line)
-                    
-                    if docstring_delimiter in stripped:
-                        # 文档字符串结束
-                        in_docstring = False
-                        
-                        # 提取并翻译文档字符串
-                        full_docstring = '\n'.join(docstring_lines)
-                        indent = len(docstring_lines[0]) - len(docstring_lines[0].lstrip())
-                        
-                        # 提取文档字符串内容（去除分隔符）
-                        doc_content_lines = []
-                        for j, dline in enumerate(docstring_lines):
-                            if j == 0:
-                                # 第一行，去除开始的分隔符
-                                content = dline.strip().lstrip(docstring_delimiter)
-                                if content:
-                                    doc_content_lines.append(content)
-                            elif j == len(docstring_lines) - 1:
-                                # 最后一行，去除结束的分隔符
-                                content = dline.strip().rstrip(docstring_delimiter)
-                                if content:
-                                    doc_content_lines.append(content)
-                            else:
-                                # 中间行
-                                doc_content_lines.append(dline.strip())
-                        
-                        doc_content = '\n'.join(doc_content_lines)
-                        
-                        if doc_content and not self._contains_chinese(doc_content):
-                            # 翻译文档字符串
-                            translated_doc = self.translate_text(doc_content, "docstring")
-                            
-                            # 重新构建文档字符串
-                            translated_lines.append(' ' * indent + docstring_delimiter)
-                            for trans_line in translated_doc.split('\n'):
-                                if trans_line.strip():
-                                    translated_lines.append(' ' * indent + trans_line)
-                            translated_lines.append(' ' * indent + docstring_delimiter)
-                        else:
-                            # 保持原样
-                            translated_lines.extend(docstring_lines)
-                        
-                        docstring_lines = []
-            
-            # 合并翻译后的内容
-            translated_content = '\n'.join(translated_lines)
-            
-            # 如果是dry run模式，只显示差异
-            if dry_run:
-                if translated_content != original_content:
-                    print(f"\n{'='*60}")
-                    print(f"文件: {file_path}")
-                    print(f"{'='*60}")
-                    print("将进行翻译...")
-                    return True
-                else:
-                    print(f"跳过（无需翻译）: {file_path}")
-                    return True
+        except Exception as e:
+            print(f"✗ 处理文件失败 {file_path}: {e}")
+            return False
+    
+    async def _translate_template(self, unique: List[Tuple[str, str]]) -> List[str]:
+        """
+        按文件结构指纹翻译一个文件的全部待翻译文本
+        
+        指纹是按顺序排列的 (上下文类型, 文本) 序列的哈希。指纹相同的文件
+        （如结构一致的__init__.py或测试文件）复用同一份译文，不再发送请求；
+        本次运行中正在翻译的同指纹文件会等待同一个任务。内存中最多保留
+        TEMPLATE_MEMO_SIZE个已完成的指纹；有条目翻译失败的指纹在任务结束后
+        立即移除，后续同结构文件会重新翻译。
+        
+        参数:
+            unique: 文件中去重后的 (文本, 上下文类型) 列表
             
-            # 写入翻译后的内容
+        返回:
+            与unique一一对应的译文列表
+        """
+        digest = hashlib.sha256(self.model.encode('utf-8'))
+        for text, context in unique:
+            digest.update(b'\x00' + context.encode('utf-8') + b'\x00' + text.encode('utf-8'))
+        fingerprint = digest.hexdigest()
+        
+        task = self._templates.get(fingerprint)
+        if task is None:
+            task = asyncio.ensure_future(self._translate_new_template(fingerprint, unique))
+            self._templates[fingerprint] = task
+        else:
+            self._templates.move_to_end(fingerprint)
+        
+        try:
+            translations = await task
+        except BaseException:
+            if self._templates.get(fingerprint) is task:
+                del self._templates[fingerprint]
+            raise
+        
+        if any(translated == text for translated, (text, _) in zip(translations, unique)):
+            # 部分翻译失败的结果不供其他文件复用
+            if self._templates.get(fingerprint) is task:
+                del self._templates[fingerprint]
+        else:
+            # 从最久未使用的一端淘汰已完成的指纹，进行中的任务保留
+            for key in list(self._templates):
+                if len(self._templates) <= self.TEMPLATE_MEMO_SIZE:
+                    break
+                if self._templates[key].done():
+                    del self._templates[key]
+        return list(translations)
+    
+    async def _translate_new_template(self, fingerprint: str,
+                                      unique: List[Tuple[str, str]]) -> List[str]:
+        """查询持久化缓存中的指纹，未命中时翻译并在全部成功后写入缓存"""
+        if self._cache is not None:
+            translations = self._cache.get_template(fingerprint)
+            if translations is not None and len(translations) == len(unique):
+                return translations
+        
+        translations = await self.translate_texts(unique)
+        if self._cache is not None and all(
+            translated != text for translated, (text, _) in zip(translations, unique)
+        ):
+            self._cache.set_template(fingerprint, translations)
+        return translations
+    
+    async def read_source(self, file_path: str) -> str:
+        """在工作线程中读取Python源文件内容，不阻塞事件循环"""
+        return await asyncio.to_thread(self._read_file, file_path)
+    
+    @staticmethod
+    def _read_file(file_path: str) -> str:
+        """读取文件内容"""
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    
+    async def write_result(self, file_path: str, original_content: str,
+                           translated_content: str, dry_run: bool = False) -> bool:
+        """
+        写入翻译后的文件内容
+        
+        参数:
+            file_path: Python文件路径
+            original_content: 原始文件内容
+            translated_content: 翻译后的文件内容
+            dry_run: 如果为True，只显示将要进行的更改，不实际修改文件
+            
+        返回:
+            成功返回True
+        """
+        # 如果是dry run模式，只显示差异
+        if dry_run:
             if translated_content != original_content:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(translated_content)
-                print(f"✓ 已翻译: {file_path}")
+                print(f"\n{'='*60}")
+                print(f"文件: {file_path}")
+                print(f"{'='*60}")
+                print("将进行翻译...")
                 return True
             else:
-                print(f"- 跳过（无需翻译）: {file_path}")
+                print(f"跳过（无需翻译）: {file_path}")
                 return True
-                
-        except Exception as e:
-            print(f"✗ 处理文件失败 {file_path}: {e}")
-            return False
+        
+        # 写入翻译后的内容
+        if translated_content != original_content:
+            await asyncio.to_thread(self._write_atomic, file_path, translated_content)
+            self.files_written += 1
+            print(f"✓ 已翻译: {file_path}")
+            return True
+        else:
+            print(f"- 跳过（无需翻译）: {file_path}")
+            return True
     
-    def _split_code_comment(self, line: str) -> Tuple[str, str]:
+    def _write_atomic(self, file_path: str, content: str) -> None:
         """
-        分离代码行中的代码部分和注释部分
+        先写入同目录的临时文件再原子替换，避免写到一半时崩溃导致源文件损坏
+        
+        参数:
+            file_path: 目标文件路径
+            content: 要写入的内容
+        """
+        # 符号链接写入其指向的真实文件，而不是把链接本身替换为普通文件
+        file_path = os.path.realpath(file_path)
+        directory, name = os.path.split(file_path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(content)
+            # 保留原文件的权限位
+            shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def collect_candidates(self, spans: List[SourceSpan]) -> List[Tuple[str, str]]:
+        """
+        从提取结果中收集需要翻译的去重文本
+        
+        参数:
+            spans: 提取出的注释和文档字符串
+            
+        返回:
+            按首次出现顺序排列的 (文本, 上下文类型) 列表
+        """
+        translatable = self._translatable_mask([span.text for span in spans])
+        return list(dict.fromkeys(
+            (span.text, span.context) for span, ok in zip(spans, translatable) if ok
+        ))
+    
+    def extract_spans(self, content: str) -> List[SourceSpan]:
+        """
+        提取源码中的注释和文档字符串
+        
+        注释由tokenize识别；文档字符串由ast识别，即模块、类和函数体的
+        第一条字符串表达式语句。
         
         参数:
-            line: 代码行
+            content: 文件内容
             
         返回:
-            (代码部分, 注释部分) 的元组
-        """
-        # 简单的分割，不处理字符串中的#
-        if '#' not in line:
-            return line, ''
-        
-        # 查找第一个不在字符串中的#
-        in_string = False
-        string_char = None
-        
-        for i, char in enumerate(line):
-            if char in ('"', "'") and (i == 0 or line[i-1] != '\\'):
-                if not in_string:
-                    in_string = True
-                    string_char = char
-                elif char == string_char:
-                    in_string = False
-                    string_char = None
-            elif char == '#' and not in_string:
-                code_part = line[:i].rstrip()
-                comment_part = line[i+1:].strip()
-                return code_part, comment_part
-        
-        return line, ''
+            按出现顺序排列的SourceSpan列表
+        """
+        # UTF-8 BOM会让ast解析失败，去掉后提取再把偏移整体后移一位，写回时BOM保持不变
+        if content.startswith('\ufeff'):
+            return [
+                span._replace(start=span.start + 1, end=span.end + 1)
+                for span in self.extract_spans(content[1:])
+            ]
+        
+        # 快速跳过：没有注释和字符串、或没有英文单词的文件无需逐token扫描
+        if '#' not in content and '"' not in content and "'" not in content:
+            return []
+        if not self._ENGLISH_WORD_RE.search(content):
+            return []
+        
+        # 每行在内容中的起始偏移，用于把 (行, 列) 转换为偏移；只保存整数，不复制行文本
+        line_offsets = [0]
+        line_offsets.extend(m.end() for m in re.finditer('\n', content))
+        if line_offsets[-1] != len(content):
+            line_offsets.append(len(content))
+        
+        docstrings = self._docstring_offsets(content, line_offsets)
+        
+        spans = []
+        for tok in tokenize.generate_tokens(io.StringIO(content).readline):
+            if tok.type not in (tokenize.COMMENT, tokenize.STRING):
+                continue
+            
+            start = line_offsets[tok.start[0] - 1] + tok.start[1]
+            end = line_offsets[tok.end[0] - 1] + tok.end[1]
+            
+            if tok.type == tokenize.COMMENT:
+                text = tok.string[1:].strip()
+                if not self._is_directive(tok, text):
+                    spans.append(SourceSpan(start, end, tok.string, text, "comment", tok.start[1]))
+            elif docstrings.get(start) == end:
+                # 隐式拼接的多段字符串不会满足结束位置相同的条件，保持原样
+                text = self._docstring_text(tok.string)
+                if text is not None:
+                    spans.append(SourceSpan(start, end, tok.string, text, "docstring", tok.start[1]))
+        
+        return spans
+    
+    def _is_directive(self, tok: tokenize.TokenInfo, text: str) -> bool:
+        """
+        判断注释是否为不应翻译的指令
+        
+        参数:
+            tok: 注释token
+            text: 去掉#后的注释文本
+            
+        返回:
+            shebang、文件头编码声明或工具指令返回True
+        """
+        row = tok.start[0]
+        if row == 1 and tok.start[1] == 0 and tok.string.startswith('#!'):
+            return True
+        if row <= 2 and self._CODING_RE.match(text):
+            return True
+        return self._PRAGMA_RE.match(text) is not None
+    
+    @staticmethod
+    def _docstring_offsets(content: str, line_offsets: List[int]) -> dict:
+        """
+        使用ast定位模块、类和函数的文档字符串
+        
+        参数:
+            content: 文件内容
+            line_offsets: 每行在内容中的起始偏移
+            
+        返回:
+            文档字符串起始偏移到结束偏移的映射；当前解释器无法解析的文件
+            （如Python 2代码或使用更新语法的文件）返回空映射，只翻译注释
+        """
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            return {}
+        
+        def to_offset(lineno: int, byte_col: int) -> int:
+            # ast的列号是UTF-8字节偏移，需要转换为字符偏移
+            line = content[line_offsets[lineno - 1]:line_offsets[lineno]]
+            return line_offsets[lineno - 1] + len(line.encode('utf-8')[:byte_col].decode('utf-8'))
+        
+        offsets = {}
+        for node in ast.walk(tree):
+            if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            if ast.get_docstring(node, clean=False) is None:
+                continue
+            expr = node.body[0]
+            start = to_offset(expr.lineno, expr.col_offset)
+            offsets[start] = to_offset(expr.end_lineno, expr.end_col_offset)
+        return offsets
+    
+    def _docstring_text(self, source: str) -> Optional[str]:
+        """
+        从字符串token中取出文档字符串正文
+        
+        参数:
+            source: 字符串token的原始文本（含前缀和引号）
+            
+        返回:
+            去除公共缩进后的正文；字节串或f-string返回None
+        """
+        m = self._STRING_PREFIX_RE.match(source)
+        if not m or set(m.group(1).lower()) & {'b', 'f'}:
+            return None
+        quote = m.group(2)
+        body = source[m.end():len(source) - len(quote)]
+        return inspect.cleandoc(body)
+    
+    def _render_span(self, span: SourceSpan, translated: str) -> Optional[str]:
+        """
+        用翻译结果重建注释或文档字符串的源码
+        
+        参数:
+            span: 原始位置信息
+            translated: 翻译后的文本
+            
+        返回:
+            替换后的源码；无法安全替换时返回None
+        """
+        if span.context == "comment":
+            # 保留#后原有的空白
+            marker = span.source[:len(span.source) - len(span.source[1:].lstrip())]
+            return marker + ' '.join(translated.split('\n'))
+        
+        m = self._STRING_PREFIX_RE.match(span.source)
+        prefix, quote = m.group(1), m.group(2)
+        body = span.source[m.end():len(span.source) - len(quote)]
+        # 译文含有引号或在单引号字符串中换行会破坏语法，保持原样
+        if quote in translated or translated.endswith(quote[0]) or '\\' in translated:
+            return None
+        if len(quote) == 1 and '\n' in translated:
+            return None
+        
+        # 保留正文首尾的空白（如换行和结束引号前的缩进）
+        stripped = body.strip()
+        leading = body[:len(body) - len(body.lstrip())] if stripped else ''
+        trailing = body[len(body.rstrip()):] if stripped else ''
+        indent = ' ' * span.indent
+        lines = translated.split('\n')
+        lines = [lines[0]] + [indent + line if line.strip() else '' for line in lines[1:]]
+        return prefix + quote + leading + '\n'.join(lines) + trailing + quote
+    
+    def apply_translations(self, content: str, spans: List[SourceSpan], table: dict) -> str:
+        """
+        按偏移把翻译结果拼接回源码
+        
+        参数:
+            content: 原始文件内容
+            spans: 提取出的注释和文档字符串
+            table: (文本, 上下文类型) 到译文的映射
+            
+        返回:
+            替换后的文件内容
+        """
+        if not spans or not table:
+            return content
+        
+        pieces = []
+        pos = 0
+        for span in spans:
+            translated = table.get((span.text, span.context))
+            if not translated or translated == span.text:
+                continue
+            replacement = self._render_span(span, translated)
+            if replacement is None:
+                continue
+            pieces.append(content[pos:span.start])
+            pieces.append(replacement)
+            pos = span.end
+        pieces.append(content[pos:])
+        return ''.join(pieces)
 
 
-def find_python_files(directory: str, exclude_dirs: List[str] = None) -> List[str]:
+def find_python_files(directory: str, exclude_dirs: List[str] = None) -> Iterator[str]:
     """
     递归查找目录下的所有Python文件
     
+    使用os.scandir边遍历边产出路径，调用方可以在遍历完成前开始处理文件。
+    
     参数:
         directory: 要搜索的目录
         exclude_dirs: 要排除的目录列表
         
     返回:
-        Python文件路径列表
+        Python文件路径迭代器
     """
     if exclude_dirs is None:
         exclude_dirs = ['venv', '.venv', '__pycache__', '.git', '.idea', 'build', 'dist', 'node_modules']
     
-    python_files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        # 排除指定的目录
+                        if entry.name not in exclude_dirs:
+                            subdirs.append(entry.path)
+                    elif entry.name.endswith('.py') and entry.is_file():
+                        yield entry.path
+                except OSError:
+                    continue
+    except OSError:
+        return
     
-    for root, dirs, files in os.walk(directory):
-        # 排除指定的目录
-        dirs[:] = [d for d in dirs if d not in exclude_dirs]
+    for subdir in subdirs:
+        yield from find_python_files(subdir, exclude_dirs)
+
+
+async def translate_files(translator: CommentTranslator, python_files: Iterable[str],
+                          dry_run: bool = False, concurrency: int = 16) -> Tuple[int, int]:
+    """
+    并发翻译多个Python文件
+    
+    生产者从python_files逐个取出路径、提前发起读取并放入有界队列，
+    concurrency个消费者并发翻译，文件遍历、文件读取与模型请求相互重叠。
+    
+    参数:
+        translator: 翻译器实例
+        python_files: Python文件路径的可迭代对象（可以是生成器）
+        dry_run: 如果为True，只显示将要进行的更改，不实际修改文件
+        concurrency: 同时处理的最大文件数
         
-        for file in files:
-            if file.endswith('.py'):
-                python_files.append(os.path.join(root, file))
+    返回:
+        (成功数, 失败数) 的元组
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    counter = 0
+    success_count = 0
+    fail_count = 0
+    
+    async def produce() -> None:
+        for file_path in python_files:
+            # 队列中的文件在等待期间即开始读取
+            await queue.put((file_path, asyncio.ensure_future(translator.read_source(file_path))))
+        for _ in range(concurrency):
+            await queue.put(None)
+    
+    async def consume() -> None:
+        nonlocal counter, success_count, fail_count
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            file_path, read_task = item
+            counter += 1
+            print(f"\n[{counter}] 处理: {file_path}")
+            if await translator.translate_file(file_path, dry_run=dry_run, prefetched=read_task):
+                success_count += 1
+            else:
+                fail_count += 1
     
-    return python_files
+    await asyncio.gather(produce(), *(consume() for _ in range(concurrency)))
+    return success_count, fail_count
+
+
+async def translate_files_two_phase(translator: CommentTranslator, python_files: Iterable[str],
+                                    dry_run: bool = False, use_batch_api: bool = False,
+                                    poll_interval: float = 60.0) -> Tuple[int, int]:
+    """
+    全局去重模式：整个目录中相同的文本只翻译一次
+    
+    第一阶段读取并解析所有文件，收集全局去重后的待翻译文本；
+    第二阶段分批翻译这些文本（或提交到Batch API离线翻译）；
+    第三阶段把译文拼接回各文件并写入。所有文件内容会同时保存在内存中。
+    
+    参数:
+        translator: 翻译器实例
+        python_files: Python文件路径的可迭代对象
+        dry_run: 如果为True，只显示将要进行的更改，不实际修改文件
+        use_batch_api: 如果为True，使用OpenAI Batch API翻译
+        poll_interval: Batch API任务的轮询间隔秒数
+        
+    返回:
+        (成功数, 失败数) 的元组
+    """
+    # 第一阶段：并发读取所有文件，提取注释和文档字符串
+    python_files = list(python_files)
+    contents = await asyncio.gather(
+        *(translator.read_source(file_path) for file_path in python_files),
+        return_exceptions=True,
+    )
+    
+    parsed = []
+    unique = {}
+    fail_count = 0
+    for file_path, content in zip(python_files, contents):
+        try:
+            if isinstance(content, BaseException):
+                raise content
+            spans = translator.extract_spans(content)
+        except Exception as e:
+            print(f"✗ 处理文件失败 {file_path}: {e}")
+            fail_count += 1
+            continue
+        parsed.append((file_path, content, spans))
+        for item in translator.collect_candidates(spans):
+            unique[item] = None
+    
+    print(f"共 {len(parsed)} 个文件，{len(unique)} 条不重复的待翻译文本")
+    
+    # 第二阶段：每条不重复的文本只翻译一次
+    items = list(unique)
+    if use_batch_api:
+        translations = await translator.translate_texts_batch_api(items, poll_interval)
+    else:
+        translations = await translator.translate_texts(items)
+    table = dict(zip(items, translations))
+    
+    # 第三阶段：拼接并写回各文件
+    success_count = 0
+    for i, (file_path, content, spans) in enumerate(parsed, 1):
+        print(f"\n[{i}/{len(parsed)}] 处理: {file_path}")
+        try:
+            translated_content = translator.apply_translations(content, spans, table)
+            await translator.write_result(file_path, content, translated_content, dry_run)
+            success_count += 1
+        except Exception as e:
+            print(f"✗ 处理文件失败 {file_path}: {e}")
+            fail_count += 1
+    
+    return success_count, fail_count
 
 
 def main():
@@ -314,6 +1394,18 @@ def main():
     
     # 使用自定义模型API
     python translate_comments.py . --base-url http://localhost:8000/v1 --model gpt-4
+    
+    # 短注释使用本地CTranslate2模型翻译（需安装ctranslate2、transformers、sentencepiece）
+    python translate_comments.py . --nmt-model ./opus-mt-en-zh-ct2
+    
+    # 全局去重：整个目录中相同的注释只翻译一次
+    python translate_comments.py . --two-phase
+    
+    # 使用OpenAI Batch API离线翻译整个目录
+    python translate_comments.py . --batch --base-url https://api.openai.com/v1 --model gpt-4o-mini
+    
+    # 限制并发数和请求速率
+    python translate_comments.py . --concurrency 8 --max-requests-per-minute 600
         """
     )
     
@@ -358,6 +1450,87 @@ def main():
         help='要排除的目录列表'
     )
     
+    parser.add_argument(
+        '--cache-path',
+        type=str,
+        default=os.getenv('PHONE_AGENT_TRANSLATE_CACHE', '.translate_cache.db'),
+        help='持久化翻译缓存文件路径'
+    )
+    
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='不使用持久化翻译缓存'
+    )
+    
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=int(os.getenv('PHONE_AGENT_CONCURRENCY', '16')),
+        help='同时处理的最大文件数'
+    )
+    
+    parser.add_argument(
+        '--max-tokens',
+        type=int,
+        default=None,
+        help='固定的最大输出token数，默认按输入长度估算'
+    )
+    
+    parser.add_argument(
+        '--nmt-model',
+        type=str,
+        default=os.getenv('PHONE_AGENT_NMT_MODEL'),
+        help='本地CTranslate2格式英译中模型目录，短注释将使用该模型翻译'
+    )
+    
+    parser.add_argument(
+        '--nmt-max-chars',
+        type=int,
+        default=80,
+        help='短于该长度的注释使用本地模型翻译'
+    )
+    
+    parser.add_argument(
+        '--nmt-target-prefix',
+        type=str,
+        default='>>cmn_Hans<<',
+        help='加在原文前的目标语言标记（opus-mt-en-zh需要>>cmn_Hans<<输出简体中文），传空字符串则不添加'
+    )
+    
+    parser.add_argument(
+        '--two-phase',
+        action='store_true',
+        help='全局去重模式：先扫描全部文件，整个目录中相同的文本只翻译一次'
+    )
+    
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='使用OpenAI Batch API离线翻译（费用更低，最长24小时完成），隐含--two-phase'
+    )
+    
+    parser.add_argument(
+        '--batch-poll-interval',
+        type=float,
+        default=60.0,
+        help='Batch API任务的轮询间隔秒数'
+    )
+    
+    parser.add_argument(
+        '--max-requests-per-minute',
+        type=float,
+        default=0,
+        help='每分钟最大请求数，0表示不限制'
+    )
+    
+    parser.add_argument(
+        '--max-tokens-per-minute',
+        type=float,
+        default=0,
+        help='每分钟最大token数，0表示不限制'
+    )
+    
     args = parser.parse_args()
     
     # 检查目录是否存在
@@ -365,16 +1538,10 @@ def main():
         print(f"错误: 目录不存在: {args.directory}")
         sys.exit(1)
     
-    # 查找所有Python文件
+    # 边扫描边处理Python文件
     print(f"正在扫描目录: {args.directory}")
     python_files = find_python_files(args.directory, args.exclude)
     
-    if not python_files:
-        print("未找到Python文件")
-        sys.exit(0)
-    
-    print(f"找到 {len(python_files)} 个Python文件")
-    
     if args.dry_run:
         print("\n【DRY RUN模式 - 不会实际修改文件】\n")
     
@@ -382,20 +1549,40 @@ def main():
     translator = CommentTranslator(
         base_url=args.base_url,
         model=args.model,
-        api_key=args.apikey
+        api_key=args.apikey,
+        max_requests_per_minute=args.max_requests_per_minute,
+        max_tokens_per_minute=args.max_tokens_per_minute,
+        cache_path=None if args.no_cache else args.cache_path,
+        max_concurrent_requests=args.concurrency,
+        nmt_model_path=args.nmt_model,
+        nmt_max_chars=args.nmt_max_chars,
+        nmt_target_prefix=args.nmt_target_prefix,
+        max_tokens=args.max_tokens
     )
     
-    # 翻译每个文件
-    success_count = 0
-    fail_count = 0
-    
-    for i, file_path in enumerate(python_files, 1):
-        print(f"\n[{i}/{len(python_files)}] 处理: {file_path}")
-        
-        if translator.translate_file(file_path, dry_run=args.dry_run):
-            success_count += 1
+    # 并发翻译所有文件
+    try:
+        if args.two_phase or args.batch:
+            success_count, fail_count = asyncio.run(
+                translate_files_two_phase(
+                    translator, python_files, args.dry_run,
+                    use_batch_api=args.batch, poll_interval=args.batch_poll_interval
+                )
+            )
         else:
-            fail_count += 1
+            success_count, fail_count = asyncio.run(
+                translate_files(translator, python_files, args.dry_run, max(1, args.concurrency))
+            )
+    finally:
+        translator.close()
+    
+    # 所有文件写完后统一刷盘一次，而不是逐文件fsync
+    if translator.files_written and hasattr(os, 'sync'):
+        os.sync()
+    
+    if success_count + fail_count == 0:
+        print("未找到Python文件")
+        sys.exit(0)
     
     # 显示总结
     print(f"\n{'='*60}")